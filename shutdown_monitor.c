@@ -0,0 +1,291 @@
+/*
+ * shutdown_monitor.c
+ * Copyright 2020 Greg Green <ggreen@bit-builder.com>
+ *
+ * C version of shutdown_monitor.py for the Raspberry Pi, built with
+ * libgpiod (v2 API). Sets the "i am running" pin, then waits in the
+ * kernel for the shutdown signal sent by the Chart Plotter Hat. If
+ * the signal is held long enough, kill opencpn with 'pkill', then
+ * replace this process with 'poweroff' to shutdown the Pi cleanly.
+ *
+ * Reads the same environment variables as the script:
+ *   OPENCPN_PKILL_DELAY, OPENCPN_USER (required)
+ *   SHUTDOWN_ACTIVE_STATE "high" (default) or "low"
+ *   SHUTDOWN_PULL "up", "down" or "none" (default)
+ *
+ * to build on the Pi, needs libgpiod-dev 2.x:
+ * make shutdown-monitor-c
+ * with other pins for a deployment:
+ * make shutdown-monitor-c PI_CDEFS="-DSHUTDOWN_PIN=17 -DMCU_RUNNING_PIN=27"
+ *
+ */
+
+#include <fcntl.h>
+#include <sched.h>
+#include <spawn.h>
+#include <stdbool.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <unistd.h>
+#include <sys/wait.h>
+
+#include <gpiod.h>
+
+extern char **environ;
+
+// environment variables
+#define PKILL_DELAY "OPENCPN_PKILL_DELAY"
+#define PKILL_USER "OPENCPN_USER"
+#define ACTIVE_STATE "SHUTDOWN_ACTIVE_STATE"
+#define PULL "SHUTDOWN_PULL"
+
+// gpio character device
+#define GPIO_CHIP "/dev/gpiochip0"
+#define CONSUMER "shutdown_monitor"
+
+// raspberry pi gpio pin numbers and delay constants, these can be
+// set for a deployment at build time, e.g. -DSHUTDOWN_PIN=17
+#ifndef SHUTDOWN_PIN
+#define SHUTDOWN_PIN 22
+#endif
+#ifndef MCU_RUNNING_PIN
+#define MCU_RUNNING_PIN 23
+#endif
+#ifndef SHUTDOWN_PULSE_MINIMUM
+#define SHUTDOWN_PULSE_MINIMUM 600              // milliseconds
+#endif
+#ifndef OPENCPN_EXIT_CHECK
+#define OPENCPN_EXIT_CHECK 100                  // milliseconds
+#endif
+
+// real time priority so the edge wakeups are not delayed by opencpn
+#define SCHED_PRIORITY 10
+
+/*--------------------------------------------------------*/
+// CLOCK_MONOTONIC now, in nanoseconds
+static int64_t
+monotonic_ns(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (int64_t)ts.tv_sec * 1000000000 + ts.tv_nsec;
+}
+
+/*--------------------------------------------------------*/
+// request the running pin as an output held active until exit, and
+// the shutdown pin with edge detection on both edges. The edges are
+// reported relative to the active state. Returns NULL on error
+static struct gpiod_line_request *
+request_lines(bool active_low, enum gpiod_line_bias bias)
+{
+    static const unsigned int running_pin = MCU_RUNNING_PIN;
+    static const unsigned int shutdown_pin = SHUTDOWN_PIN;
+    struct gpiod_line_request *request = NULL;
+    struct gpiod_line_settings *running;
+    struct gpiod_line_settings *shutdown;
+    struct gpiod_line_config *line_cfg;
+    struct gpiod_request_config *req_cfg;
+    struct gpiod_chip *chip;
+
+    chip = gpiod_chip_open(GPIO_CHIP);
+    if (chip == NULL)
+        return NULL;
+    running = gpiod_line_settings_new();
+    shutdown = gpiod_line_settings_new();
+    line_cfg = gpiod_line_config_new();
+    req_cfg = gpiod_request_config_new();
+    if (running == NULL || shutdown == NULL
+        || line_cfg == NULL || req_cfg == NULL)
+        goto out;
+
+    gpiod_line_settings_set_direction(running, GPIOD_LINE_DIRECTION_OUTPUT);
+    gpiod_line_settings_set_output_value(running, GPIOD_LINE_VALUE_ACTIVE);
+    gpiod_line_settings_set_edge_detection(shutdown, GPIOD_LINE_EDGE_BOTH);
+    gpiod_line_settings_set_active_low(shutdown, active_low);
+    gpiod_line_settings_set_bias(shutdown, bias);
+    if (gpiod_line_config_add_line_settings(line_cfg, &running_pin, 1,
+                                            running) < 0
+        || gpiod_line_config_add_line_settings(line_cfg, &shutdown_pin, 1,
+                                               shutdown) < 0)
+        goto out;
+    gpiod_request_config_set_consumer(req_cfg, CONSUMER);
+    request = gpiod_chip_request_lines(chip, req_cfg, line_cfg);
+
+out:
+    // the request keeps its own file descriptor, the rest can go
+    gpiod_request_config_free(req_cfg);
+    gpiod_line_config_free(line_cfg);
+    gpiod_line_settings_free(shutdown);
+    gpiod_line_settings_free(running);
+    gpiod_chip_close(chip);
+    return request;
+}
+
+/*--------------------------------------------------------*/
+// block until an edge event of type 'edge' is read from the request,
+// store the kernel timestamp of the event (ns) in 'ts_ns'. Returns
+// 1 on the edge, 0 if 'timeout' (ms, -1 forever) expires, -1 on error
+static int
+wait_for_edge(struct gpiod_line_request *request,
+              struct gpiod_edge_event_buffer *buffer,
+              enum gpiod_edge_event_type edge, int timeout, int64_t *ts_ns)
+{
+    int64_t deadline = monotonic_ns() + (int64_t)timeout * 1000000;
+    struct gpiod_edge_event *event;
+    int64_t left;
+    int rv;
+
+    for (;;) {
+        if (timeout < 0) {
+            left = -1;
+        } else {
+            left = deadline - monotonic_ns();
+            if (left <= 0)
+                return 0;
+        }
+        rv = gpiod_line_request_wait_edge_events(request, left);
+        if (rv <= 0)
+            return rv;
+        // one event at a time, the next wait may be looking for the
+        // edge that follows this one
+        if (gpiod_line_request_read_edge_events(request, buffer, 1) < 1)
+            return -1;
+        event = gpiod_edge_event_buffer_get_event(buffer, 0);
+        if (gpiod_edge_event_get_event_type(event) == edge) {
+            *ts_ns = (int64_t)gpiod_edge_event_get_timestamp_ns(event);
+            return 1;
+        }
+    }
+}
+
+/*--------------------------------------------------------*/
+// run a command without a shell, returns its exit status or -1
+static int
+run(char *const argv[], int quiet)
+{
+    posix_spawn_file_actions_t actions;
+    pid_t pid;
+    int status;
+    int rv;
+
+    posix_spawn_file_actions_init(&actions);
+    if (quiet)
+        posix_spawn_file_actions_addopen(&actions, STDOUT_FILENO,
+                                         "/dev/null", O_WRONLY, 0);
+    rv = posix_spawn(&pid, argv[0], &actions, NULL, argv, environ);
+    posix_spawn_file_actions_destroy(&actions);
+    if (rv != 0 || waitpid(pid, &status, 0) < 0)
+        return -1;
+    return WIFEXITED(status) ? WEXITSTATUS(status) : -1;
+}
+
+/*--------------------------------------------------------*/
+int
+main(void)
+{
+    struct sched_param param = { .sched_priority = SCHED_PRIORITY };
+    enum gpiod_line_bias bias = GPIOD_LINE_BIAS_AS_IS;
+    struct gpiod_line_request *request;
+    struct gpiod_edge_event_buffer *buffer;
+    int64_t active_at, inactive_at, deadline;
+    const char *env;
+    char *end;
+    long opencpn_pkill_delay;
+    char *opencpn_user;
+    bool active_low = false;
+    int rv;
+
+    // get environment variable(s)
+    env = getenv(PKILL_DELAY);
+    if (env == NULL) {
+        fprintf(stderr, "%s environment variable not defined, quitting\n",
+                PKILL_DELAY);
+        return 1;
+    }
+    opencpn_pkill_delay = strtol(env, &end, 10);
+    if (*env == '\0' || *end != '\0') {
+        fprintf(stderr, "%s must be an integer, quitting\n", PKILL_DELAY);
+        return 1;
+    }
+    opencpn_user = getenv(PKILL_USER);
+    if (opencpn_user == NULL) {
+        fprintf(stderr, "%s environment variable not defined, quitting\n",
+                PKILL_USER);
+        return 1;
+    }
+    env = getenv(ACTIVE_STATE);
+    if (env != NULL && strcmp(env, "low") == 0) {
+        active_low = true;
+    } else if (env != NULL && strcmp(env, "high") != 0) {
+        fprintf(stderr, "%s must be 'high' or 'low', quitting\n", ACTIVE_STATE);
+        return 1;
+    }
+    env = getenv(PULL);
+    if (env != NULL && strcmp(env, "up") == 0) {
+        bias = GPIOD_LINE_BIAS_PULL_UP;
+    } else if (env != NULL && strcmp(env, "down") == 0) {
+        bias = GPIOD_LINE_BIAS_PULL_DOWN;
+    } else if (env != NULL && strcmp(env, "none") != 0) {
+        fprintf(stderr, "%s must be 'up', 'down' or 'none', quitting\n", PULL);
+        return 1;
+    }
+
+    if (sched_setscheduler(0, SCHED_FIFO, &param) < 0)
+        fprintf(stderr, "Unable to set real time priority, continuing\n");
+
+    request = request_lines(active_low, bias);
+    if (request == NULL) {
+        perror(GPIO_CHIP);
+        return 1;
+    }
+    buffer = gpiod_edge_event_buffer_new(1);
+    if (buffer == NULL) {
+        perror("edge event buffer");
+        return 1;
+    }
+
+    for (;;) {
+        // block in the kernel until the pin goes active, then it must
+        // stay active for the minimum pulse time
+        if (gpiod_line_request_get_value(request, SHUTDOWN_PIN)
+            == GPIOD_LINE_VALUE_ACTIVE)
+            active_at = monotonic_ns();
+        else if (wait_for_edge(request, buffer, GPIOD_EDGE_EVENT_RISING_EDGE,
+                               -1, &active_at) < 0)
+            break;
+        rv = wait_for_edge(request, buffer, GPIOD_EDGE_EVENT_FALLING_EDGE,
+                           SHUTDOWN_PULSE_MINIMUM, &inactive_at);
+        if (rv < 0)
+            break;
+        // still active past the minimum pulse time, or the kernel edge
+        // timestamps show a long enough pulse even if we woke up late
+        if (rv == 0
+            || inactive_at - active_at >= (int64_t)SHUTDOWN_PULSE_MINIMUM * 1000000) {
+            char *pkill[] = { "/usr/bin/pkill", "-u", opencpn_user, "opencpn", NULL };
+            char *pgrep[] = { "/usr/bin/pgrep", "-u", opencpn_user, "opencpn", NULL };
+            struct timespec check = { 0, OPENCPN_EXIT_CHECK * 1000000L };
+
+            printf("Detected shutdown signal, powering off..\n");
+            fflush(stdout);
+            // back to normal priority, so pkill, pgrep and poweroff do
+            // not preempt opencpn while it exits
+            param.sched_priority = 0;
+            sched_setscheduler(0, SCHED_OTHER, &param);
+            run(pkill, 0);
+            // wait up to the delay for opencpn to exit
+            deadline = monotonic_ns() + opencpn_pkill_delay * 1000000000LL;
+            while (monotonic_ns() < deadline && run(pgrep, 1) == 0)
+                nanosleep(&check, NULL);
+            // replace this process with the shutdown command
+            execl("/usr/bin/sudo", "sudo", "/sbin/poweroff", (char *)NULL);
+            perror("/usr/bin/sudo");
+            return 1;
+        }
+    }
+
+    perror("shutdown pin");
+    return 1;
+}
@@ -13,61 +13,131 @@ cleanly.
 import sys
 import time
 import os
-# raspberry pi imports
-import gpiozero
+import select
+import signal
+import subprocess
 
 # environment variables
 PKILL_DELAY = "OPENCPN_PKILL_DELAY"
 PKILL_USER = "OPENCPN_USER"
+ACTIVE_STATE = "SHUTDOWN_ACTIVE_STATE"   # "high" (default) or "low"
+PULL = "SHUTDOWN_PULL"                   # "up", "down" or "none" (default)
+
+# gpio character device
+GPIO_CHIP = "/dev/gpiochip0"
 
 # raspberry pi gpio pin numbers and delay constants
 SHUTDOWN_PIN = 22
 MCU_RUNNING_PIN = 23
 SHUTDOWN_PULSE_MINIMUM = 600              # milliseconds
-SHUTDOWN_WAIT_DELAY = 20                  # milliseconds
+OPENCPN_EXIT_CHECK = 100                  # milliseconds
+
+# the delays converted for the wait calls
+SHUTDOWN_HOLD_S = SHUTDOWN_PULSE_MINIMUM / 1000.0
+SHUTDOWN_HOLD_NS = SHUTDOWN_PULSE_MINIMUM * 1000000
+OPENCPN_EXIT_CHECK_S = OPENCPN_EXIT_CHECK / 1000.0
+
+# real time priority so the edge wakeups are not delayed by opencpn
+SCHED_PRIORITY = 10
+
+def wait_for_edge(request, poller, edge, timeout=None):
+    """ block until an edge event of type 'edge' is read from the line
+    request, returns the kernel timestamp of the event (CLOCK_MONOTONIC
+    ns), or None if the timeout (seconds) expires first """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            return None
+        if not poller.poll(remaining):
+            return None
+        # one event at a time, the next wait may be looking for the
+        # edge that follows this one
+        event = request.read_edge_events(max_events=1)[0]
+        if event.event_type == edge:
+            return event.timestamp_ns
 
 def main():
     """ main function """
+    # systemd stops the service with SIGTERM, exit from the blocking wait
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
     # get environment variable(s)
     try:
         opencpn_pkill_delay = int(os.environ[PKILL_DELAY])
-    except KeyError:
-        print("{} environment variable not defined, quitting".format(PKILL_DELAY))
-        sys.exit(1)
-    try:
         opencpn_user = os.environ[PKILL_USER]
-    except KeyError:
-        print("{} environment variable not defined, quitting".format(PKILL_USER))
-        sys.exit(1)
+    except KeyError as err:
+        sys.exit("{} environment variable not defined, quitting".format(err.args[0]))
+    except ValueError:
+        sys.exit("{} must be an integer, quitting".format(PKILL_DELAY))
+    active_state = os.environ.get(ACTIVE_STATE, "high")
+    if active_state not in ("high", "low"):
+        sys.exit("{} must be 'high' or 'low', quitting".format(ACTIVE_STATE))
+    pull = os.environ.get(PULL, "none")
+    if pull not in ("up", "down", "none"):
+        sys.exit("{} must be 'up', 'down' or 'none', quitting".format(PULL))
 
-    # the shutdown pin, active state is high
-    shutdown_button = gpiozero.Button(SHUTDOWN_PIN,
-                                      pull_up=None,
-                                      active_state=True,
-                                      hold_time=SHUTDOWN_PULSE_MINIMUM/1000.0)
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(SCHED_PRIORITY))
+    except PermissionError:
+        print("Unable to set real time priority, continuing", flush=True)
 
-    # the "i am running" pin
-    running_device = gpiozero.DigitalOutputDevice(MCU_RUNNING_PIN,
-                                                  active_high=True,
-                                                  initial_value=True)
+    # raspberry pi imports, only loaded once the environment is good
+    import gpiod
+    if not hasattr(gpiod, "request_lines"):
+        sys.exit("libgpiod 2.x python bindings are required, quitting")
+    from gpiod.line import Bias, Direction, Edge, Value
 
-    # set initial state
-    running_device.on()
+    # the "i am running" pin is held high until exit. The shutdown pin
+    # edge events are read straight from the gpio character device, the
+    # edges are reported relative to the active state
+    request = gpiod.request_lines(
+        GPIO_CHIP,
+        consumer="shutdown_monitor",
+        config={
+            MCU_RUNNING_PIN: gpiod.LineSettings(direction=Direction.OUTPUT,
+                                                output_value=Value.ACTIVE),
+            SHUTDOWN_PIN: gpiod.LineSettings(edge_detection=Edge.BOTH,
+                                             active_low=active_state == "low",
+                                             bias={"up": Bias.PULL_UP,
+                                                   "down": Bias.PULL_DOWN,
+                                                   "none": Bias.AS_IS}[pull]),
+        })
+    poller = select.epoll()
+    poller.register(request.fd, select.EPOLLIN)
 
-    sleep_interval = 1                             # start out with 1 second sleep
     while True:
-        if shutdown_button.is_pressed:
-            sleep_interval = SHUTDOWN_WAIT_DELAY / 1000.0
-            if shutdown_button.is_held:
-                print("Detected shutdown signal, powering off..")
-                os.system("/usr/bin/pkill -u {} opencpn".format(opencpn_user))
-                time.sleep(opencpn_pkill_delay)
-                # execute the shutdown command
-                os.system("/usr/bin/sudo /sbin/poweroff")
-                sys.exit(0)
+        # block in the kernel until the pin goes active, then it must
+        # stay active for the minimum pulse time
+        if request.get_value(SHUTDOWN_PIN) == Value.ACTIVE:
+            active_at = time.monotonic_ns()
         else:
-            sleep_interval = 1
-        time.sleep(sleep_interval)
+            active_at = wait_for_edge(request, poller,
+                                      gpiod.EdgeEvent.Type.RISING_EDGE)
+        inactive_at = wait_for_edge(request, poller,
+                                    gpiod.EdgeEvent.Type.FALLING_EDGE,
+                                    timeout=SHUTDOWN_HOLD_S)
+        # still active past the minimum pulse time, or the kernel edge
+        # timestamps show a long enough pulse even if we woke up late
+        if inactive_at is None or inactive_at - active_at >= SHUTDOWN_HOLD_NS:
+            break
+
+    print("Detected shutdown signal, powering off..", flush=True)
+    # back to normal priority, so pkill, pgrep and poweroff do not
+    # preempt opencpn while it exits
+    os.sched_setscheduler(0, os.SCHED_OTHER, os.sched_param(0))
+    subprocess.run(["/usr/bin/pkill", "-u", opencpn_user, "opencpn"],
+                   check=False)
+    # wait up to the delay for opencpn to exit
+    deadline = time.monotonic() + opencpn_pkill_delay
+    while time.monotonic() < deadline:
+        if subprocess.run(["/usr/bin/pgrep", "-u", opencpn_user, "opencpn"],
+                          stdout=subprocess.DEVNULL,
+                          check=False).returncode != 0:
+            break
+        time.sleep(OPENCPN_EXIT_CHECK_S)
+    # replace this process with the shutdown command
+    os.execv("/usr/bin/sudo", ["sudo", "/sbin/poweroff"])
 
 if __name__ == '__main__':
     main()